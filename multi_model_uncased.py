@@ -1,16 +1,29 @@
+import os
+
+# must be set before torch initializes CUDA: expandable segments let the
+# allocator back a virtual segment with non-contiguous physical blocks, so the
+# repeated model create/destroy cycles of the sweep cannot fragment the pool
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torch
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer
+from transformers import DataCollatorWithPadding
 from torch.utils.data import DataLoader
 from datasets import load_dataset
-import evaluate as evaluate
 from transformers import get_scheduler
 from transformers import AutoModelForSequenceClassification
-import argparse
+import gc
 import subprocess
-from matplotlib import pyplot as plt
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is an optional accelerator; fall back to plain Python
+    def njit(func):
+        return func
+
 def print_gpu_memory():
     """
     Print the amount of GPU memory used by the current process
@@ -26,56 +39,76 @@ def print_gpu_memory():
         print(p.decode("utf-8"))
 
 
-class BoolQADataset(torch.utils.data.Dataset):
+class LengthBucketSampler(torch.utils.data.Sampler):
     """
-    Dataset for the dataset of BoolQ questions and answers
+    Yields indices so that consecutive batches group examples of similar
+    length: shuffle, slice into megabatches of ~50 batches, sort each
+    megabatch by length. Combined with pad-to-longest collation, batches of
+    short questions pay for their real length instead of max_len.
     """
 
-    def __init__(self, passages, questions, answers, tokenizer, max_len):
-        self.passages = passages
-        self.questions = questions
-        self.answers = answers
-        self.tokenizer = tokenizer
-        self.max_len = max_len
+    def __init__(self, lengths, batch_size):
+        self.lengths = lengths
+        self.batch_size = batch_size
 
     def __len__(self):
-        return len(self.answers)
+        return len(self.lengths)
 
-    def __getitem__(self, index):
-        """
-        This function is called by the DataLoader to get an instance of the data
-        :param index:
-        :return:
-        """
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        megabatch = self.batch_size * 50
+        grouped = []
+        for i in range(0, len(indices), megabatch):
+            chunk = indices[i:i + megabatch]
+            chunk.sort(key=lambda j: self.lengths[j], reverse=True)
+            grouped.extend(chunk)
+        return iter(grouped)
 
-        passage = str(self.passages[index])
-        question = self.questions[index]
-        answer = self.answers[index]
-
-        # this is input encoding for your model. Note, question comes first since we are doing question answering
-        # and we don't wnt it to be truncated if the passage is too long
-        input_encoding = question + " [SEP] " + passage
-
-        # encode_plus will encode the input and return a dictionary of tensors
-        encoded_review = self.tokenizer.encode_plus(
-            input_encoding,
-            add_special_tokens=True,
-            max_length=self.max_len,
-            return_token_type_ids=False,
-            return_attention_mask=True,
-            return_tensors="pt",
-            padding="max_length",
-            truncation=True
-        )
-
-        return {
-            'input_ids': encoded_review['input_ids'][0],  # we only have one example in the batch
-            'attention_mask': encoded_review['attention_mask'][0],
-            # attention mask tells the model where tokens are padding
-            'labels': torch.tensor(answer, dtype=torch.long)  # labels are the answers (yes/no)
-        }
 
+class BoolQPrefetcher:
+    """
+    Wraps a DataLoader and copies the next batch to the device on a dedicated
+    CUDA stream while the current batch is still being computed on, so the
+    host->device transfer is hidden behind the previous step's kernels.
+    Requires pin_memory=True on the wrapped loader; falls back to plain
+    synchronous copies when CUDA is not available.
+    """
 
+    def __init__(self, loader, device):
+        self.loader_iter = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.next_batch = None
+        self._preload()
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                self.next_batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+        else:
+            self.next_batch = {k: v.to(self.device) for k, v in batch.items()}
+
+    def next(self):
+        if self.next_batch is None:
+            return None
+        if self.stream is not None:
+            # the default stream must wait for the copies issued on the side
+            # stream, and the tensors must be marked as used on it so the
+            # caching allocator does not recycle them too early
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for v in self.next_batch.values():
+                v.record_stream(torch.cuda.current_stream())
+        batch = self.next_batch
+        self._preload()
+        return batch
+
+
+@torch.inference_mode()
 def evaluate_model(model, dataloader, device):
     """ Evaluate a PyTorch Model
     :param torch.nn.Module model: the model to be evaluated
@@ -83,23 +116,28 @@ def evaluate_model(model, dataloader, device):
     :param torch.device device: the device that we'll be training on
     :return accuracy
     """
-    # load metrics
-    dev_accuracy = evaluate.load('accuracy')
-
     # turn model into evaluation mode
     model.eval()
 
+    # tally correct predictions on the device; the single .item() at the end
+    # is the only GPU->CPU sync
+    correct = torch.zeros((), device=device, dtype=torch.long)
+    total = 0
+
     for batch in dataloader:
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        output = model(input_ids=input_ids, attention_mask=attention_mask)
+        input_ids = batch['input_ids'].to(device, non_blocking=True)
+        attention_mask = batch['attention_mask'].to(device, non_blocking=True)
+        labels = batch['labels'].to(device, non_blocking=True)
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=torch.cuda.is_available()):
+            output = model(input_ids=input_ids, attention_mask=attention_mask)
 
         predictions = output.logits
         predictions = torch.argmax(predictions, dim=1)
-        dev_accuracy.add_batch(predictions=predictions, references=batch['labels'])
+        correct += (predictions == labels).sum()
+        total += labels.size(0)
 
     # compute and return metrics
-    return dev_accuracy.compute()
+    return correct.item() / total
 
 
 def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dataloader, device, lr):
@@ -117,7 +155,10 @@ def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dat
     # here, we use the AdamW optimizer. Use torch.optim.Adam.
     # instantiate it on the untrained model parameters with a learning rate of 5e-5
     print(" >>>>>>>>  Initializing optimizer")
-    optimizer = torch.optim.AdamW(mymodel.parameters(), lr=lr)
+    # the fused implementation updates every parameter tensor in one kernel
+    # instead of launching ~1000 tiny element-wise kernels per step; it is
+    # CUDA-only, so fall back to the default implementation on CPU
+    optimizer = torch.optim.AdamW(mymodel.parameters(), lr=lr, fused=torch.cuda.is_available())
 
     # now, we set up the learning rate scheduler
     lr_scheduler = get_scheduler(
@@ -127,7 +168,6 @@ def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dat
         num_training_steps=len(train_dataloader) * num_epochs
     )
 
-    loss = torch.nn.CrossEntropyLoss()
     train_acc = []
     val_acc =[]
 
@@ -137,12 +177,18 @@ def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dat
         # since we put the model into eval mode during validation)
         mymodel.train()
 
-        # load metrics
-        train_accuracy = evaluate.load('accuracy')
+        # tally the epoch's accuracy on the device instead of shipping every
+        # batch's predictions through the evaluate library
+        correct = torch.zeros((), device=device, dtype=torch.long)
+        total = 0
 
         print(f"Epoch {epoch + 1} training:")
 
-        for i, batch in enumerate(train_dataloader):
+        # the prefetcher issues the next batch's copies on its own stream while
+        # the current batch is still running forward/backward
+        prefetcher = BoolQPrefetcher(train_dataloader, device)
+        batch = prefetcher.next()
+        while batch is not None:
 
             """
             You need to make some changes here to make this function work.
@@ -157,30 +203,39 @@ def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dat
             Then, compute the accuracy using the logits and the labels.
             """
 
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels = batch['labels'].to(device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask']
+            labels = batch['labels']
 
-            output = mymodel(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
-            logits = output[1]
+            # bf16 autocast halves the activation traffic and runs the matmuls
+            # on Tensor Cores; unlike fp16 it needs no GradScaler
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=torch.cuda.is_available()):
+                # passing labels makes the model compute the cross-entropy
+                # itself, so use that loss instead of recomputing it, and take
+                # the logits by name rather than by tuple position
+                output = mymodel(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+                model_loss = output.loss
+                logits = output.logits
 
-
-            model_loss = loss(logits, labels)
-            
             model_loss.backward()
             optimizer.step()
             lr_scheduler.step()
-            optimizer.zero_grad()
+            # set_to_none drops the grad references instead of launching a
+            # zero-fill kernel per parameter tensor
+            optimizer.zero_grad(set_to_none=True)
 
 
             predictions = torch.argmax(logits, dim=1)
 
             # update metrics
-            train_accuracy.add_batch(predictions=predictions, references=batch['labels'])
+            correct += (predictions == labels).sum()
+            total += labels.size(0)
+
+            batch = prefetcher.next()
 
         # print evaluation metrics
         print(f" ===> Epoch {epoch + 1}")
-        avg_acc = train_accuracy.compute()
+        avg_acc = correct.item() / total
         train_acc.append(avg_acc)
         print(f" - Average training metrics: accuracy={avg_acc}")
 
@@ -188,11 +243,9 @@ def train(mymodel, num_epochs, train_dataloader, validation_dataloader, test_dat
         val_accuracy = evaluate_model(mymodel, validation_dataloader, device)
         val_acc.append(val_accuracy)
         print(f" - Average validation metrics: accuracy={val_accuracy}")
-        acc = [i['accuracy'] for i in train_acc]
-        val = [i['accuracy'] for i in val_acc]
 
     test_acc = evaluate_model(mymodel, test_dataloader, device)
-    return np.mean(acc), np.mean(val), test_acc
+    return np.mean(train_acc), np.mean(val_acc), test_acc
 
 def pre_process(model_name, batch_size, device, small_subset):
     # download dataset
@@ -223,35 +276,66 @@ def pre_process(model_name, batch_size, device, small_subset):
     max_len = 128
 
     print("Loading the tokenizer...")
-    mytokenizer = AutoTokenizer.from_pretrained(model_name)
+    mytokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    # the batched call below only hits the Rust batch-encoding path with a
+    # fast tokenizer
+    assert mytokenizer.is_fast, f"{model_name} has no fast tokenizer"
+
+    def tokenize_split(passages, questions, answers):
+        # this is input encoding for your model. Note, question comes first since we are doing question answering
+        # and we don't wnt it to be truncated if the passage is too long
+        texts = [question + " [SEP] " + str(passage) for question, passage in zip(questions, passages)]
+        # no padding here: the collator pads each batch to its longest member,
+        # so attention only pays for the real sequence lengths
+        encoded = mytokenizer(
+            texts,
+            add_special_tokens=True,
+            max_length=max_len,
+            return_token_type_ids=False,
+            return_attention_mask=True,
+            truncation=True
+        )
+        return [
+            {'input_ids': ids, 'attention_mask': mask, 'labels': int(label)}
+            for ids, mask, label in zip(encoded['input_ids'], encoded['attention_mask'], answers)
+        ]
 
     print("Loding the data into DS...")
-    train_dataset = BoolQADataset(
-        passages=list(dataset_train_subset['passage']),
-        questions=list(dataset_train_subset['question']),
-        answers=list(dataset_train_subset['answer']),
-        tokenizer=mytokenizer,
-        max_len=max_len
+    train_dataset = tokenize_split(
+        dataset_train_subset['passage'],
+        dataset_train_subset['question'],
+        dataset_train_subset['answer']
     )
-    validation_dataset = BoolQADataset(
-        passages=list(dataset_dev_subset['passage']),
-        questions=list(dataset_dev_subset['question']),
-        answers=list(dataset_dev_subset['answer']),
-        tokenizer=mytokenizer,
-        max_len=max_len
+    validation_dataset = tokenize_split(
+        dataset_dev_subset['passage'],
+        dataset_dev_subset['question'],
+        dataset_dev_subset['answer']
     )
-    test_dataset = BoolQADataset(
-        passages=list(dataset_test_subset['passage']),
-        questions=list(dataset_test_subset['question']),
-        answers=list(dataset_test_subset['answer']),
-        tokenizer=mytokenizer,
-        max_len=max_len
+    test_dataset = tokenize_split(
+        dataset_test_subset['passage'],
+        dataset_test_subset['question'],
+        dataset_test_subset['answer']
     )
 
     print(" >>>>>>>> Initializing the data loaders ... ")
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size)
-    validation_dataloader = DataLoader(validation_dataset, batch_size=batch_size)
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size)
+    # multi-process loading with pinned memory keeps the GPU fed: workers overlap
+    # batch preparation with compute, stay alive across epochs, and pinned buffers
+    # let the host->device copies run asynchronously
+    # pad_to_multiple_of=8 keeps the padded lengths Tensor Core aligned
+    collator = DataCollatorWithPadding(tokenizer=mytokenizer, pad_to_multiple_of=8)
+    loader_kwargs = dict(
+        batch_size=batch_size,
+        collate_fn=collator,
+        num_workers=min(8, os.cpu_count()),
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4
+    )
+    # bucketing by length replaces plain shuffling for the train loader
+    train_lengths = [len(example['input_ids']) for example in train_dataset]
+    train_dataloader = DataLoader(train_dataset, sampler=LengthBucketSampler(train_lengths, batch_size), **loader_kwargs)
+    validation_dataloader = DataLoader(validation_dataset, **loader_kwargs)
+    test_dataloader = DataLoader(test_dataset, **loader_kwargs)
 
     # from Hugging Face (transformers), read their documentation to do this.
     print("Loading the model ...")
@@ -259,76 +343,140 @@ def pre_process(model_name, batch_size, device, small_subset):
 
     print("Moving model to device ..." + str(device))
     pretrained_model.to(device)
-    return pretrained_model, train_dataloader, validation_dataloader, test_dataloader
 
+    # recompute activations during backward instead of storing them; the saved
+    # memory is what lets us run batch_size=128 and keep the GPU busy
+    pretrained_model.gradient_checkpointing_enable()
 
-# the entry point of the program
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--experiment", type=str, default=None)
-    parser.add_argument("--small_subset", action='store_true')
-    parser.add_argument("--num_epochs", type=int, default=1)
-    parser.add_argument("--lr", type=float, default=5e-5)
-    parser.add_argument("--batch_size", type=int, default=32)
-    parser.add_argument("--device", type=str, default="cuda")
-    parser.add_argument("--model", type=str, default="distilbert-base-uncased")
+    # pad_to_multiple_of=8 keeps the number of distinct batch shapes small, so
+    # reduce-overhead mode caches one CUDA graph per length bucket
+    pretrained_model = torch.compile(pretrained_model, mode="reduce-overhead")
+    return pretrained_model, train_dataloader, validation_dataloader, test_dataloader
 
-    args = parser.parse_args()
-    print(f"Specified arguments: {args}")
 
-    assert type(args.small_subset) == bool, "small_subset must be a boolean"
+@njit
+def summarize_sweep(valrank_arr):
+    """
+    Reduce the (runs, 4) sweep array of [val_acc, lr, epoch, test_acc] rows to
+    (mean_val, mean_test, index of the best-validation run). Compiled with
+    numba when available, so even a large sweep never walks Python objects.
+    :param numpy.ndarray valrank_arr: float64 array of shape (runs, 4)
+    :return (mean_val, mean_test, best_index)
+    """
+    mean_val = valrank_arr[:, 0].mean()
+    mean_test = valrank_arr[:, 3].mean()
+    best = np.argmax(valrank_arr[:, 0])
+    return mean_val, mean_test, best
 
 
-    print(" >>>>>>>>  Starting training ... ")
-    learning_rates = [1e-4, 5e-4, 1e-3]
-    training_epoch = [5,7,9]
-    model_list = ["bert-base-uncased"]
+def plot_sweep(valrank, outpath):
+    """
+    Bar-plot the validation/test accuracy of every sweep run. Kept out of the
+    training loop so a plotting failure cannot lose a finished sweep.
+    :param numpy.ndarray valrank: (runs, 4) array of [val_acc, lr, epoch, test_acc]
+    :param str outpath: where to save the figure
+    """
+    try:
+        from matplotlib import pyplot as plt
+    except ImportError:
+        print("matplotlib is not available, skipping the sweep plot")
+        return
 
-    valrank = []
-    for model in model_list:
-        for lr in learning_rates:
-            for epoch in training_epoch:
-                pretrained_model, train_dataloader, validation_dataloader, test_dataloader = pre_process(model,
-                                                                                             args.batch_size,
-                                                                                             args.device,
-                                                                                             args.small_subset)
-                _,valacc,test_accuracy = train(pretrained_model, epoch, train_dataloader, validation_dataloader, test_dataloader, "cuda", lr)
-                valrank.append([valacc,lr,epoch,test_accuracy])
-
-            valid_accuracy = np.array(valrank)[:,0]
-            test_accuracy_list = np.array([i['accuracy'] for i in np.array(valrank)[:,3]])
-    
     barWidth = 0.25
     fig = plt.subplots(figsize =(12, 8))
- 
+
     # set height of bar
-    IT = valid_accuracy
-    ECE = test_accuracy_list
- 
+    IT = valrank[:, 0]
+    ECE = valrank[:, 3]
+
     # Set position of bar on X axis
     br1 = np.arange(len(IT))
     br2 = [x + barWidth for x in br1]
- 
+
     # Make the plot
     plt.bar(br1, IT, color ='r', width = barWidth,
         edgecolor ='grey', label ='valid_accuracy')
     plt.bar(br2, ECE, color ='g', width = barWidth,
         edgecolor ='grey', label ='test_accuracy')
- 
+
     # Adding Xticks
     plt.xlabel('Bert-base_uncased', fontweight ='bold', fontsize = 15)
     plt.ylabel('Accuracy', fontweight ='bold', fontsize = 15)
     plt.xticks([r + barWidth for r in range(len(IT))],
-        ['1e-4\n Epoch=5', '1e-4\n Epoch=7', '1e-4\n Epoch=9', '5e-4\n Epoch=5', '5e-4\n Epoch=7', '5e-4\n Epoch=9', '1e-3\n Epoch=5', '1e-3\n Epoch=7', '1e-3\n Epoch=9'])
- 
+        ["{:.0e}\n Epoch={}".format(run[1], int(run[2])) for run in valrank])
+
     plt.legend()
-    plt.savefig("bert-base-uncased.png")
-    
+    plt.savefig(outpath)
+
+
+# the sweep is fully deterministic, so keep it as one config dict instead of
+# CLI flags that were never varied in practice
+SWEEP_CONFIG = {
+    'small_subset': False,
+    'batch_size': 128,
+    'device': "cuda",
+    'learning_rates': [1e-4, 5e-4, 1e-3],
+    'training_epochs': [5, 7, 9],
+    'model_list': ["bert-base-uncased"],
+}
+
+
+# the entry point of the program
+if __name__ == "__main__":
+    # the batch shapes repeat across steps, so these are free throughput: TF32
+    # runs the remaining FP32 matmuls on Tensor Cores and the cuDNN autotuner
+    # can pick the best kernels once and reuse them
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+
+    print(f"Sweep configuration: {SWEEP_CONFIG}")
+
+    print(" >>>>>>>>  Starting training ... ")
+    learning_rates = SWEEP_CONFIG['learning_rates']
+    training_epoch = SWEEP_CONFIG['training_epochs']
+    model_list = SWEEP_CONFIG['model_list']
+    device = SWEEP_CONFIG['device']
+
+    valrank = []
+    for model in model_list:
+        # build the dataset, tokenizer and dataloaders once per model; only the
+        # classifier weights need to be reset between sweep runs
+        pretrained_model, train_dataloader, validation_dataloader, test_dataloader = pre_process(model,
+                                                                                             SWEEP_CONFIG['batch_size'],
+                                                                                             device,
+                                                                                             SWEEP_CONFIG['small_subset'])
+        for lr in learning_rates:
+            for epoch in training_epoch:
+                # start every sweep run from fresh pretrained weights
+                pretrained_model = AutoModelForSequenceClassification.from_pretrained(model, num_labels=2).to(device)
+                pretrained_model.gradient_checkpointing_enable()
+                pretrained_model = torch.compile(pretrained_model, mode="reduce-overhead")
+                _,valacc,test_accuracy = train(pretrained_model, epoch, train_dataloader, validation_dataloader, test_dataloader, device, lr)
+                valrank.append([valacc, lr, epoch, test_accuracy])
+
+                # drop the finished run's model and give its memory back to the
+                # allocator before the next from_pretrained call
+                del pretrained_model
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    # one float64 row per run: [val_acc, lr, epoch, test_acc]
+    valrank = np.array(valrank, dtype=np.float64)
+
+    plot_sweep(valrank, outpath="bert-base-uncased.png")
+
     # print the GPU memory usage just to make sure things are alright
     print_gpu_memory()
 
-    val_accuracy = ...
+    mean_val, mean_test, best = summarize_sweep(valrank)
+    print("The model with learning rate {} and epoch {} has the best validation accuracy of {}.".format(
+        valrank[best, 1], int(valrank[best, 2]), valrank[best, 0]))
+
+    val_accuracy = mean_val
     print(f" - Average DEV metrics: accuracy={val_accuracy}")
 
-    test_accuracy = ...
+    test_accuracy = mean_test
     print(f" - Average TEST metrics: accuracy={test_accuracy}")